@@ -7,15 +7,18 @@ this content be inserted at the beginning of the HTML body.
 Usage: python3 ged2html.py input.ged output.html [ start_id ]
 """
 import argparse
+import mmap
 import os.path
 import sys
-import re
+from operator import itemgetter
 try:
     from graph_tool import Graph, GraphView, Vertex
-    from graph_tool.search import dfs_search, DFSVisitor
+    from graph_tool.search import dfs_search, dfs_iterator, DFSVisitor
+    from graph_tool.topology import label_components
 except ImportError:
     sys.exit('''ERROR: graph-tool library is needed to run this program
       (visit https://graph-tool.skewed.de/)''')
+import numpy as np
 
 if sys.hexversion < 0x030000F0:
     sys.exit("ERROR: Python 3 is needed to run this program")
@@ -33,69 +36,75 @@ HTML_HEADER = '''<!DOCTYPE html>
 
 HTML_FOOTER = '</body>\n</html>\n'
 
-class Counter(DFSVisitor):
-    """DFS visitor to count and index genealogical branches in the graph."""
-
-    def __init__(self, graph: Graph):
-        """
-        Create a new Counter instance for a given graph.
-
-        :param Graph graph: graph instance
-        """
-        self.graph = graph
-        self.roots_per_vertex = {}
-        self.count = None
-        self.root = None
-
-    def _record(self, v: Vertex):
-        """
-        Record given vertex as the member of the current branch.
-
-        :param Vertex v: vertex
-        """
-        if v not in self.roots_per_vertex:
-            self.roots_per_vertex[v] = []
-        self.roots_per_vertex[v].append(self.root)
-        self.count += 1
-
-    def discover_vertex(self, v):
-        """
-        Invoke when a vertex is encountered for the first time.
-
-        :param Vertex v: vertex
-        """
-        if self.graph.vp.gedid[v][0] == 'I':
-            self._record(v)
-        if self.graph.vp.gedid[v][0] == 'F':
-            m = self.graph.vp.spouse[v]
-            if m is not None:
-                self._record(m)
-
-    def start_vertex(self, v):
-        """
-        Invoke on the source vertex once before the start of the search.
-
-        :param Vertex v: vertex
-        """
-        self.count = 0
-        self.root = v
-
-
-class Printer(DFSVisitor):
-    """DFS visitor to convert given branch to HTML representation."""
+MONTHS = {
+    'JAN': '01',
+    'FEB': '02',
+    'MAR': '03',
+    'APR': '04',
+    'MAY': '05',
+    'JUN': '06',
+    'JUL': '07',
+    'AUG': '08',
+    'SEP': '09',
+    'OCT': '10',
+    'NOV': '11',
+    'DEC': '12',
+}
+
+# vertex property fed by each recognized (record, sub-record, tag) path;
+# keys are bytes because the parser works on the raw memory-mapped file
+PROPERTY_FROM_PATH = {
+    (b'INDI', b'NAME', b'GIVN'): 'givn',
+    (b'INDI', b'NAME', b'SURN'): 'surn',
+    (b'INDI', b'BIRT', b'DATE'): 'birt',
+    (b'INDI', b'BIRT', b'PLAC'): 'birp',
+    (b'INDI', b'DEAT', b'DATE'): 'deat',
+    (b'INDI', b'DEAT', b'PLAC'): 'deap',
+    (b'FAM', b'MARR', b'DATE'): 'date',
+    (b'FAM', b'MARR', b'PLAC'): 'plac',
+}
+
+
+def _normalize_date(value):
+    """
+    Convert a GEDCOM date (e.g. "21 APR 1926") to dotted form "1926.04.21".
+
+    :param str value: date as found in the GEDCOM file
+    :return str: date with reversed token order and numeric months
+    """
+    parts = value.split()
+    n = len(parts)
+    if n == 3:
+        # the common "DD MON YYYY" shape: day and year are plain digits
+        return parts[2] + '.' + MONTHS.get(parts[1], parts[1]) + '.' + parts[0]
+    if n == 2:
+        return (MONTHS.get(parts[1], parts[1]) + '.'
+                + MONTHS.get(parts[0], parts[0]))
+    if n == 1:
+        return MONTHS.get(parts[0], parts[0])
+    return '.'.join(MONTHS.get(part, part) for part in reversed(parts))
+
+class Printer:
+    """Converter of a genealogical branch to its HTML representation."""
 
     def __init__(self, graph: Graph, roots_per_vertex: dict,
-                 num_from_root: dict):
+                 num_from_root: dict, out: list):
         """
         Create new Printer instance for a given graph and preprocessed data.
 
         :param Graph graph: graph instance
         :param dict roots_per_vertex: a dictionary mapping every vertex into
-        a set of root vertices of all branches it belongs to
+        the set of root vertices of all branches it belongs to
         :param dict num_from_root: a dictionary mapping every branch root
-        to the label (usually the number) of its branch
+        to the number of its branch
+        :param list out: output buffer receiving the completed HTML lines
         """
         self.graph = graph
+        self.out = out
+        self.html_name = graph.vp.html_name
+        self.is_indi = graph.vp.is_indi
+        self.is_fam = graph.vp.is_fam
+        self.spouse = graph.vp.spouse
         self.roots_per_vertex = roots_per_vertex
         self.num_from_root = num_from_root
         self.level = 0
@@ -111,14 +120,14 @@ class Printer(DFSVisitor):
         :param Vertex v: vertex instance
         :return str: HTML representation
         """
-        result = self.graph.format_name(v)
-        diagrams = []
-        for root in self.roots_per_vertex[v]:
-            if root != self.root and root in self.num_from_root:
-                diagrams.append(self.num_from_root[root])
+        result = self.html_name[v]
+        diagrams = [self.num_from_root[root]
+                    for root in self.roots_per_vertex[v]
+                    if root != self.root and root in self.num_from_root]
         if diagrams:
-            result += (' → <span class=diagrams>'
-                       + ', '.join(sorted(diagrams)) + '</span>')
+            return ''.join((result, ' → <span class=diagrams>',
+                            ', '.join(map(str, sorted(diagrams))),
+                            '</span>'))
         return result
 
     def discover_vertex(self, v):
@@ -127,16 +136,21 @@ class Printer(DFSVisitor):
 
         :param Vertex v: vertex
         """
-        if self.graph.vp.gedid[v][0] == 'I':
-            line = '│ '*(self.level-1) + '├ ' if self.level else ''
-            self.lines.append(line + self._format_name(v))
+        if self.is_indi[v]:
+            if self.level:
+                prefix = ['│ '] * self.level
+                prefix[-1] = '├ '
+            else:
+                prefix = []
+            self.lines.append((prefix, self._format_name(v)))
             self.level += 1
-        if self.graph.vp.gedid[v][0] == 'F':
-            m = self.graph.vp.spouse[v]
+        elif self.is_fam[v]:
+            m = self.spouse[v]
             if m is not None:
-                line = '│ '*(self.level-1) + '┆'
-                line += self.graph.format_marriage(v)
-                self.lines.append(line + self._format_name(m))
+                prefix = ['│ '] * (self.level-1)
+                prefix.append('┆')
+                tail = self.graph.format_marriage(v)
+                self.lines.append((prefix, tail + self._format_name(m)))
 
     def finish_vertex(self, v):
         """
@@ -144,31 +158,68 @@ class Printer(DFSVisitor):
 
         :param Vertex v: vertex
         """
-        if self.graph.vp.gedid[v][0] == 'I':
+        if self.is_indi[v]:
             self.level -= 1
-            if self.lines:
-                index = len(self.lines) - 1
-                last = self.lines[index]
-                pos = self.level * 2
-                while (last[pos] == '│' and index > 0
-                       and self.lines[index-1][pos] in ['├', '│', '┆']):
-                    invis = '<span class=invis>│</span>'
-                    self.lines[index] = last[:pos] + invis + last[pos+1:]
+            lines = self.lines
+            if lines:
+                index = len(lines) - 1
+                prefix = lines[index][0]
+                col = self.level
+                while (col < len(prefix) and prefix[col] == '│ '
+                       and index > 0
+                       and col < len(lines[index-1][0])
+                       and lines[index-1][0][col] in ['├ ', '│ ', '┆']):
+                    prefix[col] = '<span class=invis>│</span> '
                     index -= 1
-                    last = self.lines[index]
-                if last[pos] == '├':
-                    last = last[:pos] + '└' + last[pos+1:]
-                elif last[pos] in ['│', '┆']:
-                    last = last[:pos] + '╵' + last[pos+1:]
-                self.lines[index] = last
-
-    def start_vertex(self, v):
+                    prefix = lines[index][0]
+                if col < len(prefix):
+                    if prefix[col] == '├ ':
+                        prefix[col] = '└ '
+                    elif prefix[col] == '│ ':
+                        prefix[col] = '╵ '
+                    elif prefix[col] == '┆':
+                        prefix[col] = '╵'
+            if self.level == 0:
+                # ancestors rewrite columns of their descendants' lines,
+                # so lines are frozen only once the search unwinds back
+                # to the top level
+                self.flush()
+
+    def flush(self):
+        """Move all completed lines into the output buffer."""
+        out = self.out
+        for prefix, tail in self.lines:
+            out.append(''.join(prefix))
+            out.append(tail)
+            out.append('<br>\n')
+        self.lines.clear()
+
+    def run(self, view, root: Vertex):
         """
-        Invoke on the source vertex once before the start of the search.
+        Print the branch rooted at the given vertex.
 
-        :param Vertex v: vertex
+        The traversal itself runs in C++ through dfs_iterator; only the
+        discover/finish bookkeeping happens in Python, driven from the
+        returned edge array with an explicit stack.
+
+        :param GraphView view: graph view restricted to main-line edges
+        :param Vertex root: root vertex of the branch
         """
-        self.root = v
+        self.root = root
+        vertex = view.vertex
+        self.discover_vertex(root)
+        stack = [int(root)]
+        seen = {int(root)}
+        for source, target in dfs_iterator(view, root, array=True):
+            if target in seen:
+                continue
+            while stack[-1] != source:
+                self.finish_vertex(vertex(stack.pop()))
+            seen.add(target)
+            self.discover_vertex(vertex(target))
+            stack.append(target)
+        while stack:
+            self.finish_vertex(vertex(stack.pop()))
 
 
 class Gatherer(DFSVisitor):
@@ -210,7 +261,11 @@ class TheGraph(Graph):
         """Create a new TheGraph instance."""
         super().__init__()
         self._vertex_by_id = {}
+        self._fam_vertices = []
         self.vp.gedid = self.new_vertex_property('string')
+        # derived from gedid after parsing, to avoid repeated string indexing
+        self.vp.is_indi = self.new_vertex_property('bool')
+        self.vp.is_fam = self.new_vertex_property('bool')
         # for @I…@ vertices
         for key in ['givn', 'surn', 'birt', 'birp', 'deap']:
             self.vp[key] = self.new_vertex_property('string')
@@ -223,24 +278,6 @@ class TheGraph(Graph):
         # family -> spouse
         self.vp.spouse = self.new_vertex_property('object')
 
-    @classmethod
-    def _from_english_month(cls, mon):
-        data = {
-            'JAN': '01',
-            'FEB': '02',
-            'MAR': '03',
-            'APR': '04',
-            'MAY': '05',
-            'JUN': '06',
-            'JUL': '07',
-            'AUG': '08',
-            'SEP': '09',
-            'OCT': '10',
-            'NOV': '11',
-            'DEC': '12',
-        }
-        return data[mon] if mon in data else mon
-
     @classmethod
     def _htmlspecialchars(cls, text: str):
         return (
@@ -275,25 +312,38 @@ class TheGraph(Graph):
         :param Vertex v: vertex instance
         :return str: HTML representation
         """
-        name = self.vp.givn[v]
-        if not name:
-            name = 'NN.'
-        if self.vp.surn[v]:
-            name += ' ' + self.vp.surn[v]
-        small = ''
-        if self.vp.birt[v] or self.vp.birp[v]:
-            small += ' *'+self.vp.birt[v]
-            if self.vp.birp[v]:
-                small += ' ('+self.vp.birp[v]+')'
-        if self.vp.deat[v] is not None:
-            small += ' †'+self.vp.deat[v]
-            if self.vp.deap[v]:
-                small += ' ('+self.vp.deap[v]+')'
-        name = self._htmlspecialchars(name)
+        parts = [self.vp.givn[v] or 'NN.']
+        surn = self.vp.surn[v]
+        if surn:
+            parts.append(' ')
+            parts.append(surn)
+        name = self._htmlspecialchars(''.join(parts))
+        small = []
+        birt = self.vp.birt[v]
+        birp = self.vp.birp[v]
+        if birt or birp:
+            small.append(' *')
+            small.append(birt)
+            if birp:
+                small.append(' (')
+                small.append(birp)
+                small.append(')')
+        deat = self.vp.deat[v]
+        if deat is not None:
+            small.append(' †')
+            small.append(deat)
+            deap = self.vp.deap[v]
+            if deap:
+                small.append(' (')
+                small.append(deap)
+                small.append(')')
         if link:
-            name = '<a href="'+self.vp.gedid[v]+'.html">' + name + '</a>'
+            name = ''.join(('<a href="', self.vp.gedid[v], '.html">',
+                            name, '</a>'))
         if small:
-            name += '<span class=dates>' + self._htmlspecialchars(small) + '</span>'
+            name = ''.join((name, '<span class=dates>',
+                            self._htmlspecialchars(''.join(small)),
+                            '</span>'))
         return name
 
     def format_marriage(self, v):
@@ -316,109 +366,160 @@ class TheGraph(Graph):
         g = cls()
         sex = None
         lastid = last0 = last1 = None
-        regex = re.compile('^(\d+)\s+(\S+)(.*)$')
-        regid = re.compile('^@([A-Z]\d+)@$')
-        with open(path, 'rt', errors='ignore') as file:
-            for line in file.readlines():
-                match = regex.match(line.strip())
-                if match is None:
+        # vertices, edges and property values are buffered during the
+        # parse and created in bulk afterwards, so that the file loop
+        # never crosses the graph_tool boundary
+        id_to_idx = {}
+        # one buffer per property, so like values stay together and each
+        # property map is resolved only once when materializing
+        prop_values = {key: [] for key in ('givn', 'surn', 'birt', 'birp',
+                                           'deat', 'deap', 'date', 'plac')}
+        edges = []        # (source index, target index, is main line)
+        spouses = []      # (family index, spouse index)
+
+        def idx_of(gedid):
+            idx = id_to_idx.get(gedid)
+            if idx is None:
+                idx = id_to_idx[gedid] = len(id_to_idx)
+            return idx
+
+        def ref_idx(value):
+            if value[:1] == b'@' and value[-1:] == b'@':
+                value = value[1:-1]
+            return idx_of(value.decode('utf-8', 'ignore'))
+
+        # local bindings for the tight loop below
+        property_from_path = PROPERTY_FROM_PATH.get
+        normalize_date = _normalize_date
+        record_deat = prop_values['deat'].append
+        record_givn = prop_values['givn'].append
+        record_surn = prop_values['surn'].append
+
+        if os.path.getsize(path) == 0:
+            return g
+        with open(path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # the file is parsed as raw bytes: tags and ids are plain
+            # ASCII, so only the values that end up in the graph are
+            # decoded, not every line of the file
+            for line in iter(mm.readline, b''):
+                stripped = line.lstrip()
+                # cheap gate: only levels 0-2 carry data we care about,
+                # so NOTE/CONC/CONT continuations are skipped untokenized
+                if not stripped or stripped[0] not in b'012':
+                    continue
+                parts = stripped.split(None, 2)
+                if len(parts) < 2 or not parts[0].isdigit():
                     continue
-                level = int(match.group(1))
-                ident = match.group(2)
-                value = match.group(3).strip()
+                # levels are single digits in practice: take the ord()
+                # fast path and fall back to int() for deeper lines
+                level = (ord(parts[0]) - 48 if len(parts[0]) == 1
+                         else int(parts[0]))
+                if level and lastid is None:
+                    continue
+                ident = parts[1]
+                # split() already ate the leading whitespace, so only the
+                # trailing newline is left to remove
+                value = parts[2].rstrip() if len(parts) > 2 else b''
 
                 if level == 0:
-                    idmatch = regid.match(ident)
                     lastid = last0 = last1 = None
+                    lastidx = None
                     sex = None
-                    if idmatch is not None:
-                        lastid = idmatch.group(1)
+                    if (ident[:1] == b'@' and ident[-1:] == b'@'
+                            and len(ident) > 2 and ident[1:2].isalpha()):
+                        lastid = ident[1:-1].decode('utf-8', 'ignore')
+                        # resolve the record's index once per record;
+                        # all sub-line handlers reuse it
+                        lastidx = idx_of(lastid)
                         last0 = value
 
-                if level == 1 and last0 is not None:
+                elif level == 1:
                     last1 = ident
-
-                if level == 1 and ident == 'DEAT':
-                    g.vp.deat[g.by_id(lastid)] = ''
-
-                if level == 1 and ident == 'SEX':
-                    sex = value
-
-                if level == 1 and ident == 'NAME':
-                    parts = value.split('/')
-                    if len(parts) >= 2:
-                        g.vp.givn[g.by_id(lastid)] = parts[0]
-                        g.vp.surn[g.by_id(lastid)] = parts[1]
-
-                if level == 2 and last0 == 'INDI' and last1 == 'NAME':
-                    if ident == 'GIVN':
-                        g.vp.givn[g.by_id(lastid)] = value
-                    if ident == 'SURN':
-                        g.vp.surn[g.by_id(lastid)] = value
-
-                if level == 2 and ident == 'DATE':
-                    parts = list(map(cls._from_english_month, value.split()))
-                    year = '.'.join(parts[::-1])
-                    if last0 == 'INDI' and last1 == 'BIRT':
-                        g.vp.birt[g.by_id(lastid)] = year
-                    if last0 == 'INDI' and last1 == 'DEAT':
-                        g.vp.deat[g.by_id(lastid)] = year
-                    if last0 == 'FAM' and last1 == 'MARR':
-                        g.vp.date[g.by_id(lastid)] = year
-
-                if level == 2:
-                    if last0 == 'INDI' and last1 == 'BIRT' and ident == 'PLAC':
-                        g.vp.birp[g.by_id(lastid)] = value
-                    if last0 == 'INDI' and last1 == 'DEAT' and ident == 'PLAC':
-                        g.vp.deap[g.by_id(lastid)] = value
-                    if last0 == 'FAM' and last1 == 'MARR' and ident == 'PLAC':
-                        g.vp.plac[g.by_id(lastid)] = value
-
-                if level == 1:
-                    add_as_main = None
-                    if last0 == 'INDI' and ident == 'FAMS':
+                    if ident == b'DEAT':
+                        record_deat((lastidx, ''))
+                    elif ident == b'SEX':
+                        sex = value
+                    elif ident == b'NAME':
+                        parts = value.split(b'/')
+                        if len(parts) >= 2:
+                            record_givn((lastidx,
+                                         parts[0].decode('utf-8', 'ignore')))
+                            record_surn((lastidx,
+                                         parts[1].decode('utf-8', 'ignore')))
+                    elif ident == b'FAMS' and last0 == b'INDI':
                         if sex is None:
                             raise Exception("undefined sex in node "+lastid)
-                        add_as_main = (sex == 'M')
-                    if last0 == 'FAM' and ident == 'CHIL':
-                        add_as_main = True
-                    if add_as_main is not None:
-                        other = value.strip('@')
-                        e = g.add_edge(g.by_id(lastid), g.by_id(other))
-                        if add_as_main:
-                            g.ep.main[e] = True
-                        else:
-                            g.vp.spouse[g.by_id(other)] = g.by_id(lastid)
+                        other_idx = ref_idx(value)
+                        edges.append((lastidx, other_idx, sex == b'M'))
+                        if sex != b'M':
+                            spouses.append((other_idx, lastidx))
+                    elif ident == b'CHIL' and last0 == b'FAM':
+                        edges.append((lastidx, ref_idx(value), True))
+
+                elif level == 2:
+                    key = property_from_path((last0, last1, ident))
+                    if key is not None:
+                        value = value.decode('utf-8', 'ignore')
+                        if ident == b'DATE':
+                            value = normalize_date(value)
+                        prop_values[key].append((lastidx, value))
+
+        g.add_vertex(len(id_to_idx))
+        for gedid, idx in id_to_idx.items():
+            v = g.vertex(idx)
+            g.vp.gedid[v] = gedid
+            g._vertex_by_id[gedid] = v
+        for key, values in prop_values.items():
+            prop = g.vp[key]
+            for idx, value in values:
+                prop[g.vertex(idx)] = value
+        if edges:
+            g.add_edge_list(np.asarray(edges, dtype=np.int64),
+                            eprops=[g.ep.main])
+        for fam_idx, spouse_idx in spouses:
+            g.vp.spouse[g.vertex(fam_idx)] = g.vertex(spouse_idx)
+        for v in g.vertices():
+            c = g.vp.gedid[v][0]
+            g.vp.is_indi[v] = (c == 'I')
+            is_fam = (c == 'F')
+            g.vp.is_fam[v] = is_fam
+            if is_fam:
+                g._fam_vertices.append(v)
         return g
 
     def fix_main_branch(self):
-        for v in self.vertices():
-            if self.vp.gedid[v][0] == 'F':
-                to_mother = to_father = None
-                mother = father = None
-                for to_parent in v.in_edges():
-                    if self.ep.main[to_parent]:
-                        if to_father is not None:
-                            raise Exception("multiple fathers in family "+g.vp.gedid[v])
-                        to_father = to_parent
-                        father = to_father.source()
-                    else:
-                        if to_mother is not None:
-                            raise Exception("multiple mothers in family "+g.vp.gedid[v])
-                        to_mother = to_parent
-                        mother = to_mother.source()
-                if mother is not None:
-                    if father is None:
-                        self.ep.main[to_mother] = True
-                        self.vp.spouse[v] = None
-                    elif mother.in_degree() and not father.in_degree():
-                        self.ep.main[to_mother] = True
-                        self.ep.main[to_father] = False
-                        self.vp.spouse[v] = father
+        # all in-degrees in one C++ call instead of per-vertex lookups
+        indeg = self.degree_property_map('in').a
+        selected = self.get_vertex_filter()[0]
+        for v in self._fam_vertices:
+            if selected is not None and not selected[v]:
+                continue
+            to_mother = to_father = None
+            mother = father = None
+            for to_parent in v.in_edges():
+                if self.ep.main[to_parent]:
+                    if to_father is not None:
+                        raise Exception("multiple fathers in family "+g.vp.gedid[v])
+                    to_father = to_parent
+                    father = to_father.source()
+                else:
+                    if to_mother is not None:
+                        raise Exception("multiple mothers in family "+g.vp.gedid[v])
+                    to_mother = to_parent
+                    mother = to_mother.source()
+            if mother is not None:
+                if father is None:
+                    self.ep.main[to_mother] = True
+                    self.vp.spouse[v] = None
+                elif indeg[int(mother)] and not indeg[int(father)]:
+                    self.ep.main[to_mother] = True
+                    self.ep.main[to_father] = False
+                    self.vp.spouse[v] = father
 
     def create_html_structure(self, dir_path: str):
         for v in self.vertices():
-            if self.vp.gedid[v][0] == 'I':
+            if self.vp.is_indi[v]:
                 gedid = self.vp.gedid[v]
                 with open(os.path.join(dir_path, gedid+'.html'), 'wt') as f:
                     f.write(HTML_HEADER)
@@ -491,45 +592,77 @@ if __name__ == "__main__":
         g.remove_vertex(root)
         # include all spouses
         for v in g.vertices():
-            if g.vp.selected[v] and g.vp.gedid[v][0] == 'F':
+            if g.vp.selected[v] and g.vp.is_fam[v]:
                 for w in v.in_neighbors():
                     g.vp.selected[w] = True
         g.set_vertex_filter(g.vp.selected)
 
+    # precomputing HTML representation of every individual that can
+    # appear in the output (the vertex filter is already in effect),
+    # so the printer does not re-format vertices shared between diagrams
+    g.vp.html_name = g.new_vertex_property('string')
+    verts = g.get_vertices()
+    for vi in verts[g.vp.is_indi.fa.astype(bool)]:
+        v = g.vertex(vi)
+        g.vp.html_name[v] = g.format_name(v)
+
     # filtering out the main line of inheritance
     g.fix_main_branch()
     gmain = GraphView(g, efilt=g.ep.main)
 
     # indexing connected components of the filtered graph
-    # as the genealogical branches of the tree
-    counter = Counter(g)
+    # as the genealogical branches of the tree; the main-line edges form
+    # a forest, so one C++ component labelling replaces a DFS per root
+    comp_labels = label_components(gmain, directed=False)[0].a
+    verts = g.get_vertices()
+    indeg = g.get_in_degrees(verts)
+    root_from_comp = {}
+    for vi in verts[indeg == 0]:
+        root_from_comp[comp_labels[vi]] = g.vertex(vi)
+
+    # counting branch members (individuals and spouses of families)
+    # and recording which branches every individual belongs to
+    roots_per_vertex = {}
     counts = {}
+    is_indi = g.vp.is_indi
+    is_fam = g.vp.is_fam
+    spouse = g.vp.spouse
     for v in g.vertices():
-        if v.in_degree() == 0:
-            dfs_search(gmain, v, counter)
-            if counter.count > 1:
-                counts[v] = counter.count
+        root = root_from_comp.get(comp_labels[int(v)])
+        if root is None:
+            continue
+        if is_indi[v]:
+            m = v
+        elif is_fam[v]:
+            m = spouse[v]
+            if m is None:
+                continue
+        else:
+            continue
+        roots_per_vertex.setdefault(m, set()).add(root)
+        counts[root] = counts.get(root, 0) + 1
+    counts = {root: count for root, count in counts.items() if count > 1}
 
     # sorting the branches by the size in descending order
     roots = []
     num_from_root = {}
-    for v in sorted(counts, key=counts.get, reverse=True):
+    for v, count in sorted(counts.items(), key=itemgetter(1), reverse=True):
         roots.append(v)
-        num_from_root[v] = str(len(roots))
+        num_from_root[v] = len(roots)
 
     # writing results as HTML
     with open(args.out, 'wt') as f:
         f.write(HTML_HEADER)
         if not sys.stdin.isatty():
-            for line in sys.stdin:
-                f.write(line)
+            f.writelines(sys.stdin)
+        out = []
         for v in roots:
-            f.write('<h2>Diagram %s. %s</h2>\n'
-                    % (num_from_root[v], g.vp.surn[v]))
-            printer = Printer(g, counter.roots_per_vertex, num_from_root)
-            dfs_search(gmain, v, printer)
-            f.write('<p>\n')
-            for line in printer.lines:
-                f.write(line+"<br>\n")
-            f.write('</p>\n')
-        f.write(HTML_FOOTER)
+            out.append('<h2>Diagram %s. %s</h2>\n'
+                       % (num_from_root[v], g.vp.surn[v]))
+            out.append('<p>\n')
+            printer = Printer(g, roots_per_vertex, num_from_root, out)
+            printer.run(gmain, v)
+            printer.flush()
+            out.append('</p>\n')
+        out.append(HTML_FOOTER)
+        f.write(''.join(out))